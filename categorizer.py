@@ -33,17 +33,21 @@ def _by_mcc(desc_lc: str) -> Optional[Tuple[str, str]]:
         return None
     return MCC_MAP.get(m.group(1))
 
+# Every keyword in one alternation, longest first, so a single left-to-right
+# pass finds the longest keyword starting at each position. The lookahead
+# keeps matches zero-width so overlapping keywords are still all seen.
+_KEYWORD_ORDER = {k: i for i, k in enumerate(KEYWORD_MAP)}
+_KEYWORD_RX = re.compile(
+    "(?=(" + "|".join(re.escape(k) for k in sorted(KEYWORD_MAP, key=len, reverse=True)) + "))"
+)
+
 def _by_keywords(desc_lc: str) -> Optional[Tuple[str, str]]:
-    hits = []
-    for k, v in KEYWORD_MAP.items():
-        if k in desc_lc:
-            hits.append((k, v))
-    
+    hits = _KEYWORD_RX.findall(desc_lc)
     if not hits:
         return None
-    # Sort by length of the keyword match (longest match wins)
-    hits.sort(key=lambda x: len(x[0]), reverse=True)
-    return hits[0][1]
+    # Longest match wins; ties go to the keyword listed first in KEYWORD_MAP
+    best = min(hits, key=lambda k: (-len(k), _KEYWORD_ORDER[k]))
+    return KEYWORD_MAP[best]
 
 def _by_rules(desc_lc: str, amount: float) -> Optional[Tuple[str, str]]:
     # 1. FEES & INTEREST
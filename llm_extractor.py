@@ -1,10 +1,11 @@
 import base64
-import json
 import logging
 import os
+from functools import lru_cache
 from typing import Any, Dict, List
 
 import fitz  # PyMuPDF
+import orjson
 from openai import OpenAI
 
 logger = logging.getLogger("budgy-document-processor.llm_extractor")
@@ -45,38 +46,95 @@ Rules:
 - Do NOT return any additional keys besides "transactions".
 """
 
-def _pdf_to_base64_images(pdf_bytes: bytes, max_pages: int | None = None, dpi: int = 200) -> List[str]:
+# Pages are sent with detail="low", which the API downsamples to fit 512x512.
+# At 72 DPI an A4/Letter page is already ~600x840px, so rendering finer only
+# costs render, PNG encode and upload time for pixels the model never sees.
+IMAGE_DETAIL = "low"
+RENDER_DPI = 72
+
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+# Use any vision-enabled chat model you prefer (e.g. gpt-4o)
+OPENAI_VISION_MODEL = os.getenv("OPENAI_VISION_MODEL", "gpt-4o")
+
+
+def _parse_max_pages(raw: str | None) -> int | None:
+    if not raw:
+        return None
+    try:
+        return int(raw)
+    except ValueError:
+        logger.warning("Invalid LLM_PARSER_MAX_PAGES value %r, ignoring", raw)
+        return None
+
+
+LLM_PARSER_MAX_PAGES = _parse_max_pages(os.getenv("LLM_PARSER_MAX_PAGES"))
+
+if not OPENAI_API_KEY:
+    logger.warning("OPENAI_API_KEY is not set. LLM-based PDF parsing will fail.")
+
+# Separator rewrites, picked by _normalize_amount once it knows the format:
+# TR "1.234,56" drops dots and turns the decimal comma into a dot,
+# EN "1,234.56" and repeated-dot "1.234.567" just drop the thousands marks
+_TR_AMOUNT_TRANS = str.maketrans({".": None, ",": "."})
+_DROP_COMMAS_TRANS = str.maketrans({",": None})
+_DROP_DOTS_TRANS = str.maketrans({".": None})
+
+def _is_blank_page(page: "fitz.Page") -> bool:
+    """
+    A page with no text, no images and no vector drawings has nothing to
+    extract, so it is not worth rendering and sending to the LLM.
+    The cheap checks go first; get_drawings() only runs on text-less pages.
+    """
+    return (
+        not page.get_text("text").strip()
+        and not page.get_images()
+        and not page.get_drawings()
+    )
+
+
+def _pdf_to_base64_images(pdf_bytes: bytes, max_pages: int | None = None, dpi: int = RENDER_DPI) -> List[str]:
     """
     Render each page of the PDF to a PNG image and return as base64-encoded strings.
     """
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
     images_b64: List[str] = []
 
-    for page_index, page in enumerate(doc):
-        if max_pages is not None and page_index >= max_pages:
-            break
-        pix = page.get_pixmap(dpi=dpi)
-        img_bytes = pix.tobytes("png")
-        images_b64.append(base64.b64encode(img_bytes).decode("ascii"))
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        for page_index, page in enumerate(doc):
+            if max_pages is not None and page_index >= max_pages:
+                break
+            if _is_blank_page(page):
+                logger.debug("Skipping blank page %d", page_index + 1)
+                continue
+            # Encode straight from the pixmap so its raw sample buffer is freed
+            # before the next page is rendered
+            img_bytes = page.get_pixmap(dpi=dpi).tobytes("png")
+            images_b64.append(base64.b64encode(img_bytes).decode("ascii"))
 
-    logger.info(f"Rendered {len(images_b64)} page(s) to images for LLM extraction")
+    logger.info("Rendered %d page(s) to images for LLM extraction", len(images_b64))
     return images_b64
 
 
+@lru_cache(maxsize=1)
+def _get_openai_client(api_key: str) -> OpenAI:
+    """
+    Build the OpenAI client once per API key so its HTTP connection pool
+    (and TLS session) is reused across extractions.
+    """
+    return OpenAI(api_key=api_key)
+
+
 def _call_llm_for_transactions(images_b64: List[str]) -> List[Dict[str, Any]]:
     """
     Call OpenAI vision-enabled chat model with the rendered images
     and return the parsed transactions list from the JSON response.
     """
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
+    if not OPENAI_API_KEY:
         raise RuntimeError(
             "OPENAI_API_KEY environment variable is required for LLM-based PDF parsing"
         )
 
-    # Use any vision-enabled chat model you prefer (e.g. gpt-4o)
-    model_name = os.getenv("OPENAI_VISION_MODEL", "gpt-4o")
-    client = OpenAI(api_key=api_key)
+    model_name = OPENAI_VISION_MODEL
+    client = _get_openai_client(OPENAI_API_KEY)
 
     # Build multimodal content: one text instruction + all pages as images
     content: List[Dict[str, Any]] = [
@@ -95,12 +153,12 @@ def _call_llm_for_transactions(images_b64: List[str]) -> List[Dict[str, Any]]:
                 "type": "image_url",
                 "image_url": {
                     "url": f"data:image/png;base64,{b64}",
-                    "detail": "low",
+                    "detail": IMAGE_DETAIL,
                 },
             }
         )
 
-    logger.info(f"Sending {len(images_b64)} image(s) to LLM model {model_name}")
+    logger.info("Sending %d image(s) to LLM model %s", len(images_b64), model_name)
 
     response = client.chat.completions.create(
         model=model_name,
@@ -117,8 +175,8 @@ def _call_llm_for_transactions(images_b64: List[str]) -> List[Dict[str, Any]]:
         raise RuntimeError("Empty response from LLM when extracting transactions")
 
     try:
-        data = json.loads(message.content)
-    except json.JSONDecodeError as exc:
+        data = orjson.loads(message.content)
+    except orjson.JSONDecodeError as exc:
         logger.error("Failed to decode LLM JSON response", exc_info=exc)
         raise RuntimeError(f"Invalid JSON from LLM: {message.content[:200]}") from exc
 
@@ -126,14 +184,17 @@ def _call_llm_for_transactions(images_b64: List[str]) -> List[Dict[str, Any]]:
     if not isinstance(txs, list):
         raise RuntimeError("LLM response JSON must contain a 'transactions' list")
 
-    logger.info(f"LLM returned {len(txs)} raw transaction(s)")
+    logger.info("LLM returned %d raw transaction(s)", len(txs))
     return txs
 
 
 def _normalize_amount(raw_amount: Any) -> float:
     """
     Normalize amount from the LLM to a float.
-    Accepts numbers or strings like '1.234,56' or '- 1.234,56'.
+    Accepts numbers or strings like '1.234,56', '- 1.234,56' or '1,234.56'.
+    When both separators appear the last one is the decimal mark; a lone
+    comma is a TR decimal. A lone dot followed by exactly three digits
+    ('1.500') is a TR thousands separator; any other lone dot is a decimal.
     """
     if isinstance(raw_amount, (int, float)):
         return float(raw_amount)
@@ -144,12 +205,24 @@ def _normalize_amount(raw_amount: Any) -> float:
         s = s.replace("TL", "").replace("₺", "").replace("TRY", "").strip()
         # Handle spaces before minus: "- 1.234,56"
         s = s.replace(" ", "")
-        # Replace thousand separators and decimal comma
-        s = s.replace(".", "").replace(",", ".")
+        # Classify the separators, then rewrite once so float() runs once
+        last_comma = s.rfind(",")
+        last_dot = s.rfind(".")
+        if last_comma > last_dot:
+            if last_dot == -1 and s.count(",") > 1:
+                s = s.translate(_DROP_COMMAS_TRANS)  # "1,234,567"
+            else:
+                s = s.translate(_TR_AMOUNT_TRANS)
+        elif last_comma != -1:
+            s = s.translate(_DROP_COMMAS_TRANS)
+        elif last_dot != -1 and (
+            s.count(".") > 1 or (len(s) - last_dot == 4 and s[last_dot + 1 :].isdigit())
+        ):
+            s = s.translate(_DROP_DOTS_TRANS)  # "1.234.567", "1.500"
         try:
             return float(s)
         except ValueError:
-            logger.warning(f"Could not parse amount from string: {raw_amount!r}")
+            logger.warning("Could not parse amount from string: %r", raw_amount)
             raise
 
     raise TypeError(f"Unsupported amount type from LLM: {type(raw_amount)}")
@@ -169,7 +242,7 @@ def _normalize_date(raw_date: Any) -> str:
         return s
 
     # Fallback: return as-is, frontend or later logic may handle
-    logger.warning(f"Non-ISO date received from LLM, returning as-is: {s!r}")
+    logger.warning("Non-ISO date received from LLM, returning as-is: %r", s)
     return s
 
 
@@ -180,17 +253,7 @@ def extract_transactions_from_pdf_llm(pdf_bytes: bytes) -> List[Dict[str, Any]]:
     - Call vision-enabled LLM
     - Normalize to Budgi transaction schema used by TransactionRow in main.py
     """
-    max_pages_env = os.getenv("LLM_PARSER_MAX_PAGES")
-    max_pages = None
-    if max_pages_env:
-        try:
-            max_pages = int(max_pages_env)
-        except ValueError:
-            logger.warning(
-                "Invalid LLM_PARSER_MAX_PAGES value %r, ignoring", max_pages_env
-            )
-
-    images_b64 = _pdf_to_base64_images(pdf_bytes, max_pages=max_pages)
+    images_b64 = _pdf_to_base64_images(pdf_bytes, max_pages=LLM_PARSER_MAX_PAGES)
     if not images_b64:
         logger.warning("No pages rendered from PDF, returning empty transaction list")
         return []
@@ -198,6 +261,9 @@ def extract_transactions_from_pdf_llm(pdf_bytes: bytes) -> List[Dict[str, Any]]:
     raw_txs = _call_llm_for_transactions(images_b64)
 
     normalized: List[Dict[str, Any]] = []
+    # The decoded JSON holds a separate str per row even for repeated
+    # merchants, dates and currencies; share one object per distinct value
+    pool: Dict[str, str] = {}
     for idx, tx in enumerate(raw_txs):
         try:
             date = _normalize_date(tx.get("date"))
@@ -215,12 +281,12 @@ def extract_transactions_from_pdf_llm(pdf_bytes: bytes) -> List[Dict[str, Any]]:
 
             normalized.append(
                 {
-                    "date": date,
-                    "description": description,
+                    "date": pool.setdefault(date, date),
+                    "description": pool.setdefault(description, description),
                     "amount": amount,
-                    "currency": currency,
+                    "currency": pool.setdefault(currency, currency),
                     "type": tx_type,
-                    "source": source,
+                    "source": pool.setdefault(source, source),
                 }
             )
         except Exception as exc:
@@ -1,9 +1,10 @@
 import io
 import logging
 import os
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 from fastapi import Depends, FastAPI, File, Header, HTTPException, Request, UploadFile
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel, Field, validator
@@ -106,15 +107,31 @@ def _extract_and_enrich(
         logger.exception("Failed to extract transactions from PDF")
         raise HTTPException(status_code=500, detail=f"PDF extraction error: {exc}")
 
+    # APPLY FIX: Use _safe_str for all meta fields
+    # Meta is the same for every row, so resolve it once
+    row_meta = {
+        "bank_id": _safe_str(meta.get("bank_id")),
+        "account_id": _safe_str(meta.get("account_id")),
+        "card_id": _safe_str(meta.get("card_id")),
+        "document_id": _safe_str(meta.get("document_id")),
+        "file_path": _safe_str(file_path),
+        "user_profile_id": _safe_str(meta.get("user_profile_id")),
+    }
+
     transactions: List[TransactionRow] = []
+    # Statements repeat the same merchants a lot; categorize() only looks at
+    # the description and the sign of the amount, so memoize on those
+    category_cache: Dict[Tuple[str, bool], Tuple[str, str]] = {}
     
     for r in raw_rows:
         try:
             # 2. Auto-Categorize based on Description and Amount
-            cat_main, cat_sub = categorize(r["description"], r["amount"])
+            cache_key = (r["description"], r["amount"] < 0)
+            if cache_key not in category_cache:
+                category_cache[cache_key] = categorize(r["description"], r["amount"])
+            cat_main, cat_sub = category_cache[cache_key]
             
             # 3. Create Model
-            # APPLY FIX: Use _safe_str for all meta fields
             tx = TransactionRow(
                 date=r["date"],
                 description=r["description"],
@@ -124,13 +141,7 @@ def _extract_and_enrich(
                 category_main=cat_main,
                 category_sub=cat_sub,
                 source=r.get("source", "credit_card_statement"),
-                
-                bank_id=_safe_str(meta.get("bank_id")),
-                account_id=_safe_str(meta.get("account_id")),
-                card_id=_safe_str(meta.get("card_id")),
-                document_id=_safe_str(meta.get("document_id")),
-                file_path=_safe_str(file_path),
-                user_profile_id=_safe_str(meta.get("user_profile_id")),
+                **row_meta,
             )
             transactions.append(tx)
         except Exception as e:
@@ -174,8 +185,10 @@ async def process_pdf(
         "user_profile_id": user_profile_id,
     }
 
-    transactions = _extract_and_enrich(
-        contents, file_path=file.filename, meta=meta
+    # Rendering and the LLM call block for seconds; keep them off the event
+    # loop so concurrent uploads overlap
+    transactions = await run_in_threadpool(
+        _extract_and_enrich, contents, file_path=file.filename, meta=meta
     )
 
     return ProcessedDocumentResponse(
@@ -192,7 +205,7 @@ async def process_document(
 ) -> ProcessedDocumentResponse:
     logger.info("Processing document from file_path=%s", body.file_path)
 
-    pdf_bytes = download_file_from_supabase(body.file_path)
+    pdf_bytes = await run_in_threadpool(download_file_from_supabase, body.file_path)
     if pdf_bytes is None:
         raise HTTPException(
             status_code=404,
@@ -207,8 +220,8 @@ async def process_document(
         "user_profile_id": body.user_profile_id,
     }
 
-    transactions = _extract_and_enrich(
-        pdf_bytes, file_path=body.file_path, meta=meta
+    transactions = await run_in_threadpool(
+        _extract_and_enrich, pdf_bytes, file_path=body.file_path, meta=meta
     )
 
     return ProcessedDocumentResponse(
@@ -230,24 +243,31 @@ async def confirm_transactions(
         body.file_path,
     )
 
-    user_id = get_user_id_from_bearer(authorization)
+    user_id = await run_in_threadpool(get_user_id_from_bearer, authorization)
     if not user_id:
         logger.warning("User ID could not be resolved from Authorization header")
         raise HTTPException(status_code=401, detail="Unauthorized: invalid or missing token")
 
-    transactions_payload: List[Dict[str, Any]] = []
-    for tx in body.transactions:
-        # tx.dict() will now contain string defaults if fields were None
-        tx_dict = tx.dict()
-        tx_dict["user_id"] = user_id
-        tx_dict["file_path"] = _safe_str(body.file_path)
-        # Ensure IDs are passed to DB
-        tx_dict["document_id"] = _safe_str(body.document_id) or tx_dict.get("document_id")
-        tx_dict["user_profile_id"] = _safe_str(body.user_profile_id) or tx_dict.get("user_profile_id")
-        transactions_payload.append(tx_dict)
+    # Request-level values are the same for every row; resolve them once.
+    # Ensure IDs are passed to DB: a non-empty body ID wins, otherwise the
+    # row keeps its own.
+    row_overrides: Dict[str, Any] = {
+        "user_id": user_id,
+        "file_path": _safe_str(body.file_path),
+    }
+    document_id = _safe_str(body.document_id)
+    if document_id:
+        row_overrides["document_id"] = document_id
+    user_profile_id = _safe_str(body.user_profile_id)
+    if user_profile_id:
+        row_overrides["user_profile_id"] = user_profile_id
+
+    transactions_payload: List[Dict[str, Any]] = [
+        {**tx.model_dump(), **row_overrides} for tx in body.transactions
+    ]
 
     try:
-        inserted_count = save_transactions_to_db(transactions_payload)
+        inserted_count = await run_in_threadpool(save_transactions_to_db, transactions_payload)
     except Exception as exc:
         logger.exception("Error while saving transactions to Supabase")
         raise HTTPException(status_code=500, detail=f"Failed to save transactions: {exc}")
@@ -1,12 +1,30 @@
 import datetime as dt
 import logging
+import multiprocessing
+import os
 import re
-from typing import Any, Dict, List
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from itertools import chain
+from operator import itemgetter
+from typing import Any, Dict, Iterator, List
 
 import fitz  # PyMuPDF
 
 logger = logging.getLogger("budgy-document-processor.pdf_extractor")
 
+# Statements up to this many pages are parsed in-process; below it, starting
+# worker processes costs more than it saves
+SERIAL_MAX_PAGES = 10
+
+# Upper bound on extraction worker processes, whatever the host reports.
+# Note: the service itself (main.py) extracts through llm_extractor; this
+# module and its process pool only run for direct callers.
+MAX_WORKERS = 4
+
+
 # Mapping for bad PDF encoding commonly found in TR bank statements (Identity-H)
 CID_MAP = {
     "(cid:3)": " ",
@@ -53,29 +71,63 @@ IGNORE_PHRASES = [
     "numaralı sanal kredi kartınızla yapılan işlemler"
 ]
 
+# Any of IGNORE_PHRASES, matched against the lowercased description
+_IGNORE_RX = re.compile("|".join(re.escape(phrase) for phrase in IGNORE_PHRASES))
+
+# Drops the thousands dots from the integer part of a TR amount
+_THOUSANDS_TRANS = str.maketrans({".": None})
+
+# Sign, integer part (with thousands dots) and cents of a TR amount
+_AMOUNT_VALUE_RX = re.compile(r"\s*(-)?\s*([\d.]+),(\d{2})\s*(?:TL)?\s*$", re.IGNORECASE)
+
+# Cleanup passes: known CIDs first, then the REPLACEMENTS fixes together
+# with dropping any CID not in CID_MAP (same order as applying them one by one)
+_CID_RX = re.compile("|".join(re.escape(cid) for cid in CID_MAP))
+_REPLACEMENTS = dict(REPLACEMENTS)
+_FIXUP_RX = re.compile(
+    "|".join(re.escape(old) for old in _REPLACEMENTS) + r"|\(cid:\d+\)"
+)
+# ASCII control characters (0-31 and 127) except the newline, which includes '\b'
+_CTRL_TRANS = str.maketrans("", "", "".join(chr(c) for c in range(32) if c != 10) + "\x7f")
+# Whitespace runs inside a line, and line breaks with the blank lines and
+# edge spaces around them
+_WS_RX = re.compile(r"[^\S\n]+")
+_LINE_BREAK_RX = re.compile(r" ?\n[ \n]*")
+
+# One transaction block: a line starting with a DATE, optional continuation
+# lines (never starting with a date) and a line ending with an AMOUNT + TL.
+# The lazy quantifiers make the first amount line close the block.
+TRANSACTION_RX = re.compile(
+    r"^(\d{2}/\d{2}/\d{4})([^\n]*)\n"
+    r"((?:(?!\d{2}/\d{2}/\d{4})[^\n]*\n)*?)"
+    r"(?!\d{2}/\d{2}/\d{4})([^\n]*?)(-? ?[\d\.]+,\d{2}) ?TL$",
+    re.MULTILINE,
+)
+
+def _decode_cid(match: "re.Match[str]") -> str:
+    return CID_MAP[match.group(0)]
+
+def _fixup(match: "re.Match[str]") -> str:
+    return _REPLACEMENTS.get(match.group(0), "")
+
 def _clean_pdf_text(text: str) -> str:
     """
     Fix encoding artifacts and normalize whitespace.
+    Works on a whole page: every non-empty line is kept, stripped, with
+    whitespace runs collapsed to a single space.
     """
     # 1. Fix CIDs (from dictionary)
-    for cid, char in CID_MAP.items():
-        text = text.replace(cid, char)
-
-    # 2. Fix known encoding/OCR issues (from list of tuples)
-    for old, new in REPLACEMENTS:
-        text = text.replace(old, new)
-    
-    # 3. Generic CID remover if any left
-    text = re.sub(r"\(cid:\d+\)", "", text)
-    
-    # FIX: Remove all ASCII control characters (0-31 and 127), which includes '\b'
-    text = re.sub(r'[\x00-\x1F\x7F]', '', text)
-
-    # 4. Handle remaining ''
-    text = text.replace("", "")
-    
-    # 5. Whitespace cleanup
-    text = re.sub(r"\s+", " ", text).strip()
+    text = _CID_RX.sub(_decode_cid, text)
+
+    # 2. Fix known encoding/OCR issues, drop any CID left over
+    text = _FIXUP_RX.sub(_fixup, text)
+
+    # 3. Remove ASCII control characters
+    text = text.translate(_CTRL_TRANS)
+
+    # 4. Whitespace cleanup, dropping empty lines
+    text = _WS_RX.sub(" ", text)
+    text = _LINE_BREAK_RX.sub("\n", text).strip()
     return text
 
 def _parse_tr_amount(amount_str: str) -> float:
@@ -83,23 +135,17 @@ def _parse_tr_amount(amount_str: str) -> float:
     Convert '1.582,18 TL' -> 1582.18
     Convert '- 500,00 TL' -> -500.00
     """
-    # Remove TL, currency codes, and spaces/non-breaking spaces
-    s = amount_str.upper().replace("TL", "").replace("\u00a0", " ").strip()
-    
-    negative = False
-    if s.startswith("-"):
-        negative = True
-        s = s[1:].strip()
-    
-    # Remove thousands separator dot, replace decimal comma with dot
-    s = s.replace(".", "").replace(",", ".")
-    
-    try:
-        val = float(s)
-        return -val if negative else val
-    except ValueError:
+    m = _AMOUNT_VALUE_RX.match(amount_str)
+    if not m:
         return 0.0
+    sign, whole, cents = m.groups()
+
+    # Remove thousands separator dots; work in integer cents
+    whole = whole.translate(_THOUSANDS_TRANS)
+    val = (int(whole or 0) * 100 + int(cents)) / 100
+    return -val if sign else val
 
+@lru_cache(maxsize=1024)
 def _to_iso_date(tr_date: str) -> str:
     """
     Convert '02/11/2024' -> '2024-11-02'
@@ -110,95 +156,142 @@ def _to_iso_date(tr_date: str) -> str:
     except ValueError:
         return tr_date
 
+def _build_transaction(match: "re.Match[str]", pool: Dict[str, str]) -> Dict[str, Any]:
+    """
+    Turn one TRANSACTION_RX match into a transaction dict.
+    The description is the date line remainder, any continuation lines and
+    the text in front of the amount, joined by single spaces. Descriptions
+    go through `pool` so a merchant repeated across rows is stored once.
+    """
+    tr_date, first, middle, last, raw_amt = match.groups()
+    full_desc = " ".join(f"{first} {middle} {last}".split())
+    full_desc = pool.setdefault(full_desc, full_desc)
+    amount_val = _parse_tr_amount(raw_amt)
+
+    # Determine Type based on Amount Sign
+    # Positive = Expense, Negative = Income/Payment
+    tx_type = "expense" if amount_val >= 0 else "income"
+
+    return {
+        "date": _to_iso_date(tr_date),
+        "description": full_desc,
+        "amount": amount_val,
+        "currency": "TRY",
+        "type": tx_type,
+        "source": "credit_card_statement",
+    }
+
+def _page_transactions(page: "fitz.Page", pool: Dict[str, str]) -> List[Dict[str, Any]]:
+    """
+    Extract the transactions of a single page, summary rows filtered out.
+    """
+    # Use 'text' output for raw lines, then clean the page up in one go
+    raw_text = page.get_text("text")
+    if not raw_text:
+        return []
+    page_text = _clean_pdf_text(raw_text)
+
+    transactions: List[Dict[str, Any]] = []
+    for match in TRANSACTION_RX.finditer(page_text):
+        tx = _build_transaction(match, pool)
+        # Filter summary rows
+        if not _IGNORE_RX.search(tx["description"].lower()):
+            transactions.append(tx)
+    return transactions
+
+def _iter_doc_transactions(doc: "fitz.Document") -> Iterator[Dict[str, Any]]:
+    pool: Dict[str, str] = {}
+    for page in doc:
+        yield from _page_transactions(page, pool)
+
+def _process_pages(pdf_bytes: bytes, start: int, stop: int) -> List[Dict[str, Any]]:
+    """
+    Worker entrypoint: open the PDF once and extract pages [start, stop).
+    """
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        pool: Dict[str, str] = {}
+        return [tx for i in range(start, stop) for tx in _page_transactions(doc[i], pool)]
+
+def _available_cpus() -> int:
+    # sched_getaffinity honours CPU pinning (taskset, container cpusets);
+    # cpu_count() reports every core on the host
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+_WORKER_COUNT = max(1, min(MAX_WORKERS, _available_cpus()))
+_executor: ProcessPoolExecutor | None = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    """
+    One process pool for the life of the service, created on first use.
+    Workers come from a forkserver (spawn where unavailable), never from a
+    fork of the multithreaded server process.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            method = (
+                "forkserver"
+                if "forkserver" in multiprocessing.get_all_start_methods()
+                else "spawn"
+            )
+            _executor = ProcessPoolExecutor(
+                max_workers=_WORKER_COUNT,
+                mp_context=multiprocessing.get_context(method),
+            )
+        return _executor
+
+
+def _discard_executor(executor: ProcessPoolExecutor) -> None:
+    """
+    Drop a broken pool so the next large statement builds a fresh one.
+    Only clears the global if no other thread has replaced it already.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
 def extract_transactions_from_pdf(pdf_bytes: bytes) -> List[Dict[str, Any]]:
     """
     Robust extraction for Enpara/TR Credit Card statements.
-    Strategy: Line-by-line parsing. 
-    A transaction block starts with a DATE and ends with an AMOUNT.
-    """
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-    all_transactions: List[Dict[str, Any]] = []
-    
-    # Regex to identify start of a row (Date)
-    date_re = re.compile(r"^(\d{2}/\d{2}/\d{4})")
-    # Regex to identify end of a row (Amount + TL)
-    amount_re = re.compile(r"(-? ?[\d\.]+,\d{2}) ?TL$")
-
-    for page_index, page in enumerate(doc):
-        # Use 'text' output for raw lines, then clean them up
-        raw_text = page.get_text("text")
-        if not raw_text:
-            continue
-            
-        clean_lines = []
-        for line in raw_text.split('\n'):
-            cleaned = _clean_pdf_text(line)
-            if cleaned:
-                clean_lines.append(cleaned)
-        
-        # State machine parsing
-        current_tx = {}
-        
-        i = 0
-        while i < len(clean_lines):
-            line = clean_lines[i]
-            
-            # Check for Date Start
-            date_match = date_re.match(line)
-            if date_match:
-                current_tx = {
-                    "date": _to_iso_date(date_match.group(1)),
-                    "description_parts": [],
-                    "amount": None
-                }
-                
-                # The rest of this line might contain description text
-                remainder = line[len(date_match.group(0)):].strip()
-                if remainder:
-                    current_tx["description_parts"].append(remainder)
-                
-                i += 1
-                continue
-
-            # If we are inside a transaction, look for description or amount
-            if current_tx:
-                # Check for Amount (End of transaction)
-                amt_match = amount_re.search(line)
-                if amt_match:
-                    raw_amt = amt_match.group(1)
-                    # Description text before the amount on the same line
-                    desc_part = line[:amt_match.start()].strip()
-                    if desc_part:
-                        current_tx["description_parts"].append(desc_part)
-                    
-                    # Finalize Transaction
-                    full_desc = " ".join(current_tx["description_parts"])
-                    
-                    # Filter summary rows
-                    if not any(ignored in full_desc.lower() for ignored in IGNORE_PHRASES):
-                        amount_val = _parse_tr_amount(raw_amt)
-                        
-                        # Determine Type based on Amount Sign
-                        # Positive = Expense, Negative = Income/Payment
-                        tx_type = "expense" if amount_val >= 0 else "income"
-                        
-                        all_transactions.append({
-                            "date": current_tx["date"],
-                            "description": full_desc,
-                            "amount": amount_val, 
-                            "currency": "TRY",
-                            "type": tx_type,
-                            "source": "credit_card_statement"
-                        })
-                    
-                    # Reset state
-                    current_tx = {}
-                else:
-                    # Just a description line
-                    current_tx["description_parts"].append(line)
-            
-            i += 1
+    Strategy: clean the page into lines, then let TRANSACTION_RX walk the
+    whole page. A transaction block starts with a DATE and ends with an AMOUNT.
+    Pages are independent, so longer statements are split across processes.
+    """
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        page_count = doc.page_count
+        # With a single usable CPU a worker process only adds IPC
+        parallel = page_count > SERIAL_MAX_PAGES and _WORKER_COUNT > 1
+        if not parallel:
+            all_transactions = list(_iter_doc_transactions(doc))
+
+    if parallel:
+        # One contiguous page range per worker, so each process receives the
+        # PDF and parses it once
+        step = -(-page_count // _WORKER_COUNT)
+        executor = _get_executor()
+        try:
+            futures = [
+                executor.submit(_process_pages, pdf_bytes, start, min(start + step, page_count))
+                for start in range(0, page_count, step)
+            ]
+            all_transactions = list(chain.from_iterable(f.result() for f in futures))
+        except BrokenProcessPool:
+            # A worker died (e.g. MuPDF crashed on this file); the pool is
+            # unusable from here on, so replace it and parse in-process
+            logger.warning("Extraction worker pool broke; retrying %d page(s) serially", page_count)
+            _discard_executor(executor)
+            with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+                all_transactions = list(_iter_doc_transactions(doc))
 
     # Sort by date descending (newest first)
-    all_transactions.sort(key=lambda t: t["date"], reverse=True)
+    # ISO dates sort lexicographically, so the raw string is the key
+    all_transactions.sort(key=itemgetter("date"), reverse=True)
     return all_transactions
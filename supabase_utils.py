@@ -1,9 +1,17 @@
+import base64
+import gzip
+import hashlib
 import logging
 import os
+import threading
+import time
 from typing import Any, Dict, List, Optional, Tuple
 from urllib.parse import urlparse
 
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 logger = logging.getLogger("budgy-document-processor.supabase")
 
@@ -12,18 +20,74 @@ SUPABASE_SERVICE_KEY = os.getenv("SUPABASE_SERVICE_KEY")
 SUPABASE_ANON_KEY = os.getenv("SUPABASE_ANON_KEY")  # optional, mostly unused here
 SUPABASE_STORAGE_BUCKET = os.getenv("SUPABASE_STORAGE_BUCKET", "")  # optional
 SUPABASE_TRANSACTIONS_TABLE = os.getenv("SUPABASE_TRANSACTIONS_TABLE", "transactions")
+# Only enable if the gateway in front of PostgREST decodes gzip request bodies
+SUPABASE_GZIP_INSERTS = os.getenv("SUPABASE_GZIP_INSERTS", "").lower() in {"1", "true", "yes"}
 
 if not SUPABASE_URL or not SUPABASE_SERVICE_KEY:
     logger.warning(
         "SUPABASE_URL or SUPABASE_SERVICE_KEY is not set. Supabase operations will fail."
     )
 
-SESSION = requests.Session()
-DEFAULT_TIMEOUT = 30
+# Longest Retry-After wait honoured inside a request; urllib3 does not cap it
+MAX_RETRY_AFTER = 10
+
 
+class _CappedRetry(Retry):
+    """
+    Retry that clamps server Retry-After waits to MAX_RETRY_AFTER, so a
+    gateway 429 cannot park a request worker for minutes.
+    """
 
-def _supabase_headers(auth_with_service: bool = True) -> Dict[str, str]:
-    key = SUPABASE_SERVICE_KEY if auth_with_service else SUPABASE_ANON_KEY
+    def get_retry_after(self, response):  # type: ignore[override]
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, MAX_RETRY_AFTER)
+
+
+SESSION = requests.Session()
+# Keep-alive pool shared by every Supabase call. pool_maxsize bounds the
+# connections kept per host; it has to cover the request handlers running
+# concurrently in the threadpool (each holds one connection at a time, and
+# batched inserts reuse it sequentially), or urllib3 discards connections
+# and the next call pays a fresh TLS handshake.
+# Only GETs are retried: a POST insert that timed out may still have been
+# committed server-side.
+_ADAPTER = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=_CappedRetry(
+        total=3,
+        backoff_factor=0.3,
+        # 429 is the gateway rate limit; its Retry-After wait (capped at
+        # MAX_RETRY_AFTER) is honoured instead of the backoff schedule
+        status_forcelist=(429, 502, 503, 504),
+        respect_retry_after_header=True,
+        allowed_methods=frozenset({"GET"}),
+        # Hand the final 5xx back so callers log it like any other failure
+        raise_on_status=False,
+    ),
+)
+SESSION.mount("https://", _ADAPTER)
+# Local Supabase (supabase start) serves plain http
+SESSION.mount("http://", _ADAPTER)
+DEFAULT_TIMEOUT = 30
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+ERROR_BODY_LIMIT = 2048
+# PostgreSQL shows no gain past ~1,000 rows per INSERT; larger batches
+# only cost PostgREST memory and a longer single transaction
+BATCH_SIZE = 1000
+# Below this the gzip CPU cost outweighs the bytes saved on the wire
+GZIP_MIN_BYTES = 4096
+
+# Storage requests always authenticate with the service key
+_STORAGE_HEADERS = {
+    "apikey": SUPABASE_SERVICE_KEY,
+    "Authorization": f"Bearer {SUPABASE_SERVICE_KEY}",
+}
+
+
+def _build_rest_headers(key: Optional[str]) -> Dict[str, str]:
     if not key:
         key = SUPABASE_SERVICE_KEY or SUPABASE_ANON_KEY or ""
     return {
@@ -33,24 +97,117 @@ def _supabase_headers(auth_with_service: bool = True) -> Dict[str, str]:
     }
 
 
+# The key is fixed at import, so the header set is built once
+_SERVICE_HEADERS = _build_rest_headers(SUPABASE_SERVICE_KEY)
+# Insert variants are constant too: no per-batch dict merging
+_INSERT_HEADERS = {**_SERVICE_HEADERS, "Prefer": "return=minimal"}
+_INSERT_HEADERS_GZIP = {**_INSERT_HEADERS, "Content-Encoding": "gzip"}
+
+_AUTH_USER_URL = f"{SUPABASE_URL}/auth/v1/user"
+_STORAGE_OBJECT_URL = f"{SUPABASE_URL}/storage/v1/object/"
+_TRANSACTIONS_URL = f"{SUPABASE_URL}/rest/v1/{SUPABASE_TRANSACTIONS_TABLE}"
+
+
+def _truncate_body(resp: requests.Response, limit: int = ERROR_BODY_LIMIT) -> str:
+    """
+    First `limit` bytes of a response body for error logs and messages.
+    PostgREST can echo every rejected row; on streamed responses only this
+    much is read off the socket.
+    """
+    head = next(resp.iter_content(chunk_size=limit), b"")
+    return head[:limit].decode("utf-8", "replace")
+
+
 # ---------- AUTH HELPERS ----------
 
+# token -> user id lookups, keyed by sha256(token) so raw tokens are not kept
+# around. Only successful lookups are cached; entries expire after the TTL.
+USER_CACHE_TTL = 300
+USER_CACHE_MAXSIZE = 2048
+_USER_CACHE: Dict[bytes, Tuple[float, str]] = {}
+_USER_CACHE_LOCK = threading.Lock()
+
+
+def invalidate_user_cache() -> None:
+    """
+    Drop every cached token -> user id entry (e.g. after a logout).
+    """
+    with _USER_CACHE_LOCK:
+        _USER_CACHE.clear()
+
+
+def _cache_get_user_id(key: bytes) -> Optional[str]:
+    with _USER_CACHE_LOCK:
+        entry = _USER_CACHE.get(key)
+        if entry is None:
+            return None
+        expires_at, user_id = entry
+        if expires_at <= time.monotonic():
+            del _USER_CACHE[key]
+            return None
+        return user_id
+
+
+def _token_ttl(token: str) -> float:
+    """
+    Seconds to cache a token: USER_CACHE_TTL, cut short by the JWT "exp"
+    claim so a user id never outlives its token. The claim is read without
+    verifying the signature; Supabase already accepted the token.
+    """
+    try:
+        payload = token.split(".")[1]
+        claims = orjson.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        exp = float(claims["exp"])
+    except Exception:
+        return USER_CACHE_TTL
+    return min(USER_CACHE_TTL, exp - time.time())
+
+
+def _cache_put_user_id(key: bytes, user_id: str, ttl: float) -> None:
+    if ttl <= 0:
+        return
+    now = time.monotonic()
+    with _USER_CACHE_LOCK:
+        if len(_USER_CACHE) >= USER_CACHE_MAXSIZE:
+            for k in [k for k, (exp, _) in _USER_CACHE.items() if exp <= now]:
+                del _USER_CACHE[k]
+            if len(_USER_CACHE) >= USER_CACHE_MAXSIZE:
+                # Still full of live entries: evict the oldest insertion
+                del _USER_CACHE[next(iter(_USER_CACHE))]
+        _USER_CACHE[key] = (now + ttl, user_id)
+
 
 def get_user_id_from_bearer(authorization_header: Optional[str]) -> Optional[str]:
     """
     Decode the Supabase JWT via /auth/v1/user and return user id.
+    Results are cached per token for USER_CACHE_TTL seconds, or until the
+    token expires if that is sooner.
     """
     if not authorization_header:
         return None
 
-    parts = authorization_header.split(" ", 1)
-    if len(parts) != 2 or parts[0].lower() != "bearer":
+    # Slice instead of split(): no list or lowercased copy of the whole header
+    if authorization_header[:7].lower() != "bearer ":
+        return None
+
+    token = authorization_header[7:].strip()
+    if not token:
         return None
+    key = hashlib.sha256(token.encode("utf-8")).digest()
+    user_id = _cache_get_user_id(key)
+    if user_id is not None:
+        return user_id
 
-    token = parts[1]
+    user_id = _fetch_user_id(token)
+    if user_id is not None:
+        _cache_put_user_id(key, user_id, _token_ttl(token))
+    return user_id
+
+
+def _fetch_user_id(token: str) -> Optional[str]:
     try:
         resp = SESSION.get(
-            f"{SUPABASE_URL}/auth/v1/user",
+            _AUTH_USER_URL,
             headers={
                 "apikey": SUPABASE_SERVICE_KEY,
                 "Authorization": f"Bearer {token}",
@@ -62,10 +219,16 @@ def get_user_id_from_bearer(authorization_header: Optional[str]) -> Optional[str
         return None
 
     if not resp.ok:
-        logger.warning("Supabase /auth/v1/user returned %s: %s", resp.status_code, resp.text)
+        logger.warning(
+            "Supabase /auth/v1/user returned %s: %s", resp.status_code, _truncate_body(resp)
+        )
         return None
 
-    data = resp.json()
+    try:
+        data = orjson.loads(resp.content)
+    except orjson.JSONDecodeError as exc:
+        logger.warning("Supabase /auth/v1/user returned invalid JSON: %s", exc)
+        return None
     # supabase-py style vs raw REST – we handle both shapes
     if isinstance(data, dict):
         if "id" in data:
@@ -95,12 +258,13 @@ def _build_storage_url_from_path(file_path: str) -> str:
     else:
         full_path = file_path.lstrip("/")
 
-    return f"{SUPABASE_URL}/storage/v1/object/{full_path}"
+    return _STORAGE_OBJECT_URL + full_path
 
 
-def download_file_from_supabase(file_path: str) -> Optional[bytes]:
+def download_file_from_supabase(file_path: str) -> Optional[bytearray]:
     """
     Download a PDF from Supabase Storage.
+    The body is streamed into a bytearray, which PyMuPDF opens directly.
     """
     if not SUPABASE_URL or not SUPABASE_SERVICE_KEY:
         logger.error("Supabase environment variables are missing")
@@ -110,64 +274,123 @@ def download_file_from_supabase(file_path: str) -> Optional[bytes]:
     logger.info("Downloading PDF from %s", url)
 
     try:
-        resp = SESSION.get(
+        with SESSION.get(
             url,
-            headers={
-                "apikey": SUPABASE_SERVICE_KEY,
-                "Authorization": f"Bearer {SUPABASE_SERVICE_KEY}",
-            },
+            headers=_STORAGE_HEADERS,
             timeout=DEFAULT_TIMEOUT,
-        )
+            stream=True,
+        ) as resp:
+            if not resp.ok:
+                logger.error(
+                    "Supabase Storage GET failed with %s: %s",
+                    resp.status_code,
+                    _truncate_body(resp),
+                )
+                return None
+
+            # Grow one buffer in place instead of collecting every chunk and
+            # joining them, which briefly holds the file twice
+            buf = bytearray()
+            for chunk in resp.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                buf += chunk
     except Exception as exc:
         logger.error("Error downloading from Supabase Storage: %s", exc)
         return None
 
-    if not resp.ok:
-        logger.error(
-            "Supabase Storage GET failed with %s: %s", resp.status_code, resp.text
-        )
-        return None
-
-    return resp.content
+    return buf
 
 
 # ---------- DATABASE HELPERS ----------
 
 
-def save_transactions_to_db(transactions: List[Dict[str, Any]]) -> int:
+def _insert_chunk(url: str, index: Optional[int], chunk: List[Dict[str, Any]]) -> int:
     """
-    Insert confirmed transactions into Supabase REST table.
-    Returns the number of rows we *attempted* to insert.
+    POST one batch of rows. `index` names the batch in errors when the
+    insert was split; pass None for a single, unsplit insert.
     """
-    if not transactions:
-        return 0
-
-    if not SUPABASE_URL or not SUPABASE_SERVICE_KEY:
-        raise RuntimeError("Supabase configuration is missing")
-
-    url = f"{SUPABASE_URL}/rest/v1/{SUPABASE_TRANSACTIONS_TABLE}"
-    logger.info("Inserting %d transactions into %s", len(transactions), url)
+    what = "insert" if index is None else f"insert of batch {index}"
+    headers = _INSERT_HEADERS
+    # orjson encodes the row list several times faster than the
+    # stdlib json that requests uses for json=
+    body = orjson.dumps(chunk)
+    if SUPABASE_GZIP_INSERTS and len(body) >= GZIP_MIN_BYTES:
+        # Row JSON repeats the same keys and IDs, so even level 1 shrinks it
+        # several-fold
+        body = gzip.compress(body, compresslevel=1)
+        headers = _INSERT_HEADERS_GZIP
 
     try:
         resp = SESSION.post(
             url,
-            headers={
-                **_supabase_headers(auth_with_service=True),
-                "Prefer": "return=minimal",
-            },
-            json=transactions,
+            headers=headers,
+            data=body,
             timeout=DEFAULT_TIMEOUT,
         )
     except Exception as exc:
-        logger.error("Error during Supabase insert: %s", exc)
+        logger.error("Error during Supabase %s: %s", what, exc)
         raise
 
     if not resp.ok:
+        detail = _truncate_body(resp)
         logger.error(
-            "Supabase insert failed with %s: %s", resp.status_code, resp.text
+            "Supabase %s failed with %s: %s", what, resp.status_code, detail
         )
         raise RuntimeError(
-            f"Supabase insert failed with status {resp.status_code}: {resp.text}"
+            f"Supabase {what} failed with status {resp.status_code}: {detail}"
         )
 
-    return len(transactions)
+    return len(chunk)
+
+
+def save_transactions_to_db(
+    transactions: List[Dict[str, Any]], batch_size: int = BATCH_SIZE
+) -> int:
+    """
+    Insert confirmed transactions into Supabase REST table.
+    Large lists are split into batch_size-row POSTs sent one after another.
+    Each batch is its own transaction: the first failure stops the run, and
+    the error reports how many rows earlier batches already committed.
+    Returns the number of rows inserted.
+    """
+    if not transactions:
+        return 0
+
+    if not SUPABASE_URL or not SUPABASE_SERVICE_KEY:
+        raise RuntimeError("Supabase configuration is missing")
+
+    if batch_size < 1:
+        raise ValueError(f"batch_size must be positive, got {batch_size}")
+
+    # A row without date or amount fails the table constraints and would
+    # reject its whole batch; drop it before paying to encode and send it
+    valid = [
+        tx for tx in transactions
+        if tx.get("date") and tx.get("amount") is not None
+    ]
+    skipped = len(transactions) - len(valid)
+    if skipped:
+        logger.warning("Skipping %d transaction(s) missing date or amount", skipped)
+        if not valid:
+            return 0
+        transactions = valid
+
+    url = _TRANSACTIONS_URL
+    logger.info("Inserting %d transactions into %s", len(transactions), url)
+
+    batches = [
+        transactions[i : i + batch_size]
+        for i in range(0, len(transactions), batch_size)
+    ]
+    if len(batches) == 1:
+        return _insert_chunk(url, None, batches[0])
+
+    committed = 0
+    for index, batch in enumerate(batches):
+        try:
+            committed += _insert_chunk(url, index, batch)
+        except Exception as exc:
+            raise RuntimeError(
+                f"{exc} ({committed} of {len(transactions)} rows were committed "
+                f"before batch {index}; later batches were not sent)"
+            ) from exc
+    return committed